@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 import argparse
 import sys
 import glob
@@ -7,7 +7,7 @@ from gfn import (GFNs_from_filenames,
 from util import (group_by_attributes,
                   save_csv,
                   read_csv,
-                  is_blacklisted)
+                  is_blocklisted)
 
 DESCRIPTION = "Compute the weight value for all given font files."
 parser = argparse.ArgumentParser(description=DESCRIPTION)
@@ -32,8 +32,8 @@ def main():
   old_metadata = read_csv(args.input)
   print("There are {} entries in the old metadata CSV.".format(len(old_metadata.keys())))
 
-  blacklisted = [fname for fname in files_to_process if is_blacklisted(fname)]
-  files_to_process = [fname for fname in files_to_process if not is_blacklisted(fname) and \
+  blacklisted = [fname for fname in files_to_process if is_blocklisted(fname)]
+  files_to_process = [fname for fname in files_to_process if not is_blocklisted(fname) and \
                                                              GFN_from_filename(fname) in old_metadata.keys()]
 
   if blacklisted:
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # coding: utf-8
 # Copyright 2013 The Font Bakery Authors. All Rights Reserved.
 # Copyright 2017 The Google Font Tools Authors
@@ -26,12 +26,13 @@
 # font-classification-tool.py -h
 #
 import argparse
+import base64
 import collections
 import csv
 import glob
+import io
 import math
 import os
-import StringIO
 import sys
 import re
 import errno
@@ -152,7 +153,7 @@ FONT_SIZE=30
 # The text used to test weight and width. Note that this could be
 # problematic if a given font doesn't have latin support.
 LATIN_TEXT = "AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvXxYyZz"
-KHMER_TEXT = "\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84"
+KHMER_TEXT = b"\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84".decode("utf-8")
 
 
 img_counter=0
@@ -198,9 +199,9 @@ def render_single_line(fontfile, khmer=False):
 def get_base64_image(img):
   """Get the base 64 representation of an image,
      to use for visual testing."""
-  output = StringIO.StringIO()
+  output = io.BytesIO()
   img.save(output, "PNG")
-  base64img = output.getvalue().encode("base64")
+  base64img = base64.b64encode(output.getvalue()).decode("ascii")
   output.close()
   return base64img
 
@@ -1,82 +1,177 @@
 #!/usr/bin/env python3
 import csv
-from math import floor
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import io
+import os
+import pickle
+import re
 import sys
 
+try:
+  import numpy as np
+except ImportError:
+  np = None # only needed to compute darkness and width, the CSV helpers work without it
 
-def find_extremes(d):
-  """ Input: a dict key:value
-      Output: min and max values from all elements in the dict
-  """
-  values = d.values()
-  return min(values), max(values)
+try:
+  from numba import njit
+except ImportError:
+  njit = None # numba is optional, we fall back to plain numpy
+
+
+def _require_numpy():
+  if np is None:
+    sys.exit("Needs numpy.\n\npip3 install numpy")
 
 
-def group_by_attributes(fonts):
+def normalize_to_buckets(values):
+  """ Input: a numpy array of values
+      Output: a numpy array of integer scores from 1 to 10, linearly
+              mapping the smallest value to 1 and the largest to 10
+  """
+  _require_numpy()
+  v_min = values.min()
+  v_range = values.max() - v_min
+
+  if v_range == 0: # unlikely
+    return np.full(len(values), 5, dtype=np.int64)
+
+  # values - v_min is never negative, so truncating is the same as flooring.
+  # (Keep dividing before multiplying: precomputing 10/v_range rounds
+  # differently and can push values sitting on a bucket edge one bucket down.)
+  return np.minimum(10, 1 + (10 * ((values - v_min) / v_range)).astype(np.int64))
+
+
+def _compute_one(font):
+  """ Worker for the process pool in group_by_attributes. """
+  name, subsets = font
+  return compute_darkness_and_width(name, subsets)
+
+
+# Results of compute_darkness_and_width are kept across runs in this file:
+DARKNESS_CACHE = os.path.join(".cache", "darkness.pkl")
+# Bump this whenever a change to the rendering or measuring code
+# would make previously cached values wrong:
+_DARKNESS_CACHE_VERSION = 1
+
+def _load_darkness_cache(filename):
+  try:
+    with open(filename, 'rb') as f:
+      return pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError):
+    return {}
+
+
+def _save_darkness_cache(filename, cache, keys):
+  # drop entries from older cache versions and for font files
+  # that were modified since they got cached:
+  current = {key[1]: key[2:4] for key in keys}
+  for key in list(cache):
+    if key[0] != _DARKNESS_CACHE_VERSION or \
+       (key[1] in current and key[2:4] != current[key[1]]):
+      del cache[key]
+
+  dirname = os.path.dirname(filename)
+  if dirname:
+    os.makedirs(dirname, exist_ok=True)
+  # write to a temporary file first so that an interrupted
+  # run never leaves a truncated cache behind:
+  tmp = filename + '.tmp'
+  with open(tmp, 'wb') as f:
+    pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp, filename)
+
+
+def _darkness_cache_key(name, subsets):
+  """ The computed values depend on the font file contents, on the sample
+      text picked for its subsets and on how we render and measure it. """
+  st = os.stat(name)
+  return (_DARKNESS_CACHE_VERSION,
+          os.path.abspath(name), st.st_mtime_ns, st.st_size,
+          FONT_SIZE) + _sample_texts(subsets)
+
+
+def group_by_attributes(fonts, cache_file=DARKNESS_CACHE):
   """ Classify a set of fonts by their ammount of black ink (percentage of dark
       pixels in a reference paragraph of text) and attribute a normalized score
       from 1 to 10 based on their computed darkness, effectively grouping the
       fonts by their weight.
 
+      Fonts whose file did not change since a previous run reuse the values
+      stored in cache_file. Pass cache_file=None to disable the cache.
+
       Input: a list of font filenames
       Output: a dict filename:value
               where value is a weight score from 1 (lightest) to 10 (darkest)
   """
-  darkness = {}
-  width = {}
-  for name, subsets in fonts:
-    darkness[name], width[name] = compute_darkness_and_width(name, subsets)
-
-  # normalize weight values:
-  min_dark, max_dark = find_extremes(darkness)
-  dark_range = max_dark - min_dark
-
-  if dark_range == 0: # unlikely
-    weights = {name: 5 for name, _ in fonts}
-  else:
-    weights = {}
-    for name, _ in fonts:
-      weights[name] = min(10, int(1 + floor(10 * ((darkness[name] - min_dark)/ dark_range))))
-
-  # normalize width values:
-  min_width, max_width = find_extremes(width)
-  width_range = max_width - min_width
-
-  if width_range == 0: # unlikely
-    widths = {name: 5 for name, _ in fonts}
-  else:
-    widths = {}
-    for name, _ in fonts:
-      widths[name] = min(10, int(1 + floor(10 * ((width[name] - min_width)/ width_range))))
-
+  _require_numpy()
+
+  names = [name for name, _ in fonts]
+  darkness = np.empty(len(fonts))
+  width = np.empty(len(fonts))
+
+  cache = _load_darkness_cache(cache_file) if cache_file else {}
+  keys = [_darkness_cache_key(name, subsets) for name, subsets in fonts]
+  missing = []
+  for i, key in enumerate(keys):
+    if key in cache:
+      darkness[i], width[i] = cache[key]
+    else:
+      missing.append(i)
+
+  # Each font is rendered independently, so we spread them across processes.
+  # (Processes rather than threads: FreeType faces are not thread-safe.)
+  if missing:
+    try:
+      with ProcessPoolExecutor() as executor:
+        results = executor.map(_compute_one, [fonts[i] for i in missing])
+        for i, (dark, wid) in zip(missing, results):
+          darkness[i] = dark
+          width[i] = wid
+          cache[keys[i]] = (dark, wid)
+    finally:
+      # keep whatever got computed, even if some font failed:
+      if cache_file:
+        _save_darkness_cache(cache_file, cache, keys)
+
+  weights = dict(zip(names, normalize_to_buckets(darkness).tolist()))
+  widths = dict(zip(names, normalize_to_buckets(width).tolist()))
   return weights, widths
 
 
+# Values accepted on a published CSV; anything else gets blanked out:
+_VALID_SCORES = frozenset(range(1, 11))
+_VALID_USAGES = frozenset(['body', 'header'])
+
 def save_csv(filename, metadata, cleanup_for_publishing=False):
-  with open(filename, 'w') as csvfile:
-    writer = csv.writer(csvfile, delimiter=',', quotechar='"', lineterminator='\n')
-    header = ["GFN","FWE","FIA","FWI","USAGE"]
-    if not cleanup_for_publishing:
-      header.append('SUBSETS')
-    writer.writerow(header) # first row has the headers
+  items = sorted(metadata.items())
 
-    for gfn in sorted(metadata.keys()):
-      data = metadata[gfn]
-      fwe = data['weight_int']
-      fia = data['angle_int']
-      fwi = data['width_int']
-      usage = data['usage']
-      if cleanup_for_publishing:
-        if usage not in ['body', 'header']: usage = ''
-        if fwe-1 not in range(10): fwe = ''
-        if fia-1 not in range(10): fia = ''
-        if fwi-1 not in range(10): fwi = ''
+  if cleanup_for_publishing:
+    header = ["GFN","FWE","FIA","FWI","USAGE"]
+    rows = ((gfn,
+             data['weight_int'] if data['weight_int'] in _VALID_SCORES else '',
+             data['angle_int'] if data['angle_int'] in _VALID_SCORES else '',
+             data['width_int'] if data['width_int'] in _VALID_SCORES else '',
+             data['usage'] if data['usage'] in _VALID_USAGES else '')
+            for gfn, data in items)
+  else:
+    header = ["GFN","FWE","FIA","FWI","USAGE","SUBSETS"]
+    rows = ((gfn,
+             data['weight_int'],
+             data['angle_int'],
+             data['width_int'],
+             data['usage'],
+             data['subsets'])
+            for gfn, data in items)
 
-      row = [gfn, fwe, fia, fwi, usage]
-      if not cleanup_for_publishing:
-        row.append(data['subsets'])
+  # Build the whole file in memory and write it out in one go:
+  buf = io.StringIO()
+  writer = csv.writer(buf, delimiter=',', quotechar='"', lineterminator='\n')
+  writer.writerow(header) # first row has the headers
+  writer.writerows(rows)
 
-      writer.writerow(row)
+  with open(filename, 'w', buffering=1<<20) as csvfile:
+    csvfile.write(buf.getvalue())
 
 
 def read_csv(filename):
@@ -85,24 +180,23 @@ def read_csv(filename):
     existing_data = csv.reader(csvfile, delimiter=',', quotechar='"')
     next(existing_data) # skip first row as its not data
     for row in existing_data:
-      gfn = row[0]
-      if len(row) < 6:
-        subsets = None
-      else:
-        subsets = row[5]
-
+      gfn, fwe, fia, fwi, usage = row[:5]
+      subsets = row[5] if len(row) > 5 else None
       metadata[gfn] = {
-        "weight_int": int(row[1]),
-        "angle_int": int(row[2]),
-        "width_int": int(row[3]),
-        "usage": row[4],
+        "weight_int": int(fwe),
+        "angle_int": int(fia),
+        "width_int": int(fwi),
+        "usage": usage,
         "subsets": subsets
       }
   return metadata
 
 
-# Fonts that cause problems: any filenames containing these letters
-# will be skipped.
+# Fonts that cause problems will be skipped. Entries of the form
+# "Family-Style" (containing a dash) only match a file whose base name,
+# without extension, is exactly that (so "Rubik-Bold" blocks
+# "Rubik-Bold.ttf" but not "Rubik-Bold-Hinted.ttf"). Any other entry
+# blocks every filename containing it anywhere in its path.
 # TODO: Investigate why these don't work.
 BLOCKLIST = [
 ##IOError: execution context too long (issue #703)
@@ -127,13 +221,19 @@ BLOCKLIST = [
   "Rubik-Regular",
 ]
 
+# Entries naming a single style (Family-Style) are matched against the
+# file's base name with a set lookup; the remaining ones are folded into a
+# single pattern, so that each filename is scanned only once:
+_BLOCKLIST_EXACT = frozenset(name for name in BLOCKLIST if '/' not in name and '-' in name)
+_BLOCKLIST_SUBSTRINGS = [name for name in BLOCKLIST if name not in _BLOCKLIST_EXACT]
+_BLOCKLIST_RE = re.compile("|".join(map(re.escape, _BLOCKLIST_SUBSTRINGS)) or "(?!)")
+
 def is_blocklisted(filename):
   """Returns whether a font is on the blocklist."""
-
-  # first check for explicit blocklisting:
-  for name in BLOCKLIST:
-    if name in filename:
-      return True
+  basename = os.path.splitext(os.path.basename(filename))[0]
+  if basename in _BLOCKLIST_EXACT:
+    return True
+  return _BLOCKLIST_RE.search(filename) is not None
 
 # Sample code below was copied from
 # https://www.cairographics.org/cookbook/freetypepython/
@@ -152,12 +252,22 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
     "given the name of a font file, and optional faceindex to pass to FT_New_Face" \
     " and loadoptions to pass to cairo_ft_font_face_create_for_ft_face, creates" \
     " a cairo.FontFace object that may be used to render text with that font."
+    " Faces are cached, so asking twice for the same file is cheap."
+    return _create_cairo_font_face(os.fsencode(filename), faceindex, loadoptions)
+
+# Evicting a face drops the last reference to it, at which point cairo
+# calls FT_Done_Face through the user_data destructor attached below.
+@lru_cache(maxsize=256)
+def _create_cairo_font_face (path, faceindex, loadoptions):
     global _initialized
     global _freetype_so
     global _cairo_so
     global _ft_lib
     global _ft_destroy_key
     global _surface
+    global _ft_new_face, _ft_done_face
+    global _cr_ft_font_face_create, _cr_font_face_status, _cr_font_face_destroy
+    global _cr_font_face_get_user_data, _cr_font_face_set_user_data, _cr_set_font_face
 
     CAIRO_STATUS_SUCCESS = 0
     FT_Err_Ok = 0
@@ -175,6 +285,15 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
         _cairo_so.cairo_font_face_status.argtypes = [ ct.c_void_p ]
         _cairo_so.cairo_font_face_destroy.argtypes = (ct.c_void_p,)
         _cairo_so.cairo_status.argtypes = [ ct.c_void_p ]
+        # bind the entry points once, rather than looking them up on every call
+        _ft_new_face = _freetype_so.FT_New_Face
+        _ft_done_face = _freetype_so.FT_Done_Face
+        _cr_ft_font_face_create = _cairo_so.cairo_ft_font_face_create_for_ft_face
+        _cr_font_face_status = _cairo_so.cairo_font_face_status
+        _cr_font_face_destroy = _cairo_so.cairo_font_face_destroy
+        _cr_font_face_get_user_data = _cairo_so.cairo_font_face_get_user_data
+        _cr_font_face_set_user_data = _cairo_so.cairo_font_face_set_user_data
+        _cr_set_font_face = _cairo_so.cairo_set_font_face
         # initialize freetype
         _ft_lib = ct.c_void_p()
         status = _freetype_so.FT_Init_FreeType(ct.byref(_ft_lib))
@@ -185,17 +304,18 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
         _ft_destroy_key = ct.c_int() # dummy address
         _initialized = True
 
+    filename = os.fsdecode(path) # for error messages
     ft_face = ct.c_void_p()
     cr_face = None
     try :
         # load FreeType face
-        status = _freetype_so.FT_New_Face(_ft_lib, filename.encode("utf-8"), faceindex, ct.byref(ft_face))
+        status = _ft_new_face(_ft_lib, path, faceindex, ct.byref(ft_face))
         if status != FT_Err_Ok :
             raise RuntimeError("Error %d creating FreeType font face for %s" % (status, filename))
 
         # create Cairo font face for freetype face
-        cr_face = _cairo_so.cairo_ft_font_face_create_for_ft_face(ft_face, loadoptions)
-        status = _cairo_so.cairo_font_face_status(cr_face)
+        cr_face = _cr_ft_font_face_create(ft_face, loadoptions)
+        status = _cr_font_face_status(cr_face)
         if status != CAIRO_STATUS_SUCCESS :
             raise RuntimeError("Error %d creating cairo font face for %s" % (status, filename))
 
@@ -208,13 +328,13 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
         # actually unnecessary in our situation, because each call to FT_New_Face
         # will return a new FT Face, but we include it here to show how to handle the
         # general case.
-        if _cairo_so.cairo_font_face_get_user_data(cr_face, ct.byref(_ft_destroy_key)) == None :
-            status = _cairo_so.cairo_font_face_set_user_data \
+        if _cr_font_face_get_user_data(cr_face, ct.byref(_ft_destroy_key)) == None :
+            status = _cr_font_face_set_user_data \
               (
                 cr_face,
                 ct.byref(_ft_destroy_key),
                 ft_face,
-                _freetype_so.FT_Done_Face
+                _ft_done_face
               )
             if status != CAIRO_STATUS_SUCCESS :
                 raise RuntimeError("Error %d doing user_data dance for %s" % (status, filename))
@@ -224,14 +344,14 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
         # set Cairo font face into Cairo context
         cairo_ctx = cairo.Context(_surface)
         cairo_t = PycairoContext.from_address(id(cairo_ctx)).ctx
-        _cairo_so.cairo_set_font_face(cairo_t, cr_face)
-        status = _cairo_so.cairo_font_face_status(cairo_t)
+        _cr_set_font_face(cairo_t, cr_face)
+        status = _cr_font_face_status(cairo_t)
         if status != CAIRO_STATUS_SUCCESS :
             raise RuntimeError("Error %d creating cairo font face for %s" % (status, filename))
 
     finally :
-        _cairo_so.cairo_font_face_destroy(cr_face)
-        _freetype_so.FT_Done_Face(ft_face)
+        _cr_font_face_destroy(cr_face)
+        _ft_done_face(ft_face)
 
     # get back Cairo font face as a Python object
     face = cairo_ctx.get_font_face()
@@ -242,7 +362,67 @@ FONT_SIZE=30
 # The text used to test weight and width. Note that this could be
 # problematic if a given font doesn't have latin support.
 LATIN_TEXT = "AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvXxYyZz"
-KHMER_TEXT = "\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84"
+KHMER_TEXT = b"\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84".decode("utf-8")
+
+
+def _sum_alpha_numpy(buf, stride, width, height):
+  """ Sums the alpha bytes of an A8 pixel buffer. """
+  alpha = buf[:height*stride].reshape(height, stride)[:, :width]
+  # accumulating straight into uint64 lets numpy use its widest
+  # SIMD byte-sum loop; the strided view needs no copy:
+  return int(np.add.reduce(alpha, dtype=np.uint64, axis=None))
+
+if njit is None:
+  _sum_alpha = _sum_alpha_numpy
+else:
+  @njit(cache=True, fastmath=True)
+  def _sum_alpha(buf, stride, width, height):
+    """ Sums the alpha bytes of an A8 pixel buffer. """
+    s = 0
+    for y in range(height):
+      row = y*stride
+      for x in range(width):
+        s += buf[row + x]
+    return s
+
+
+_scratch_surface = None
+_scratch_ctx = None
+def _get_scratch_context(width, height, clear=True):
+  """ Returns a cairo context drawing onto a scratch surface that is
+      at least width x height pixels large, cleared unless clear=False.
+      The surface is only reallocated when it needs to grow, so it gets
+      reused across fonts.
+  """
+  global _scratch_surface
+  global _scratch_ctx
+
+  if _scratch_surface is None or \
+     _scratch_surface.get_width() < width or \
+     _scratch_surface.get_height() < height:
+    if _scratch_surface is not None:
+      width = max(width, _scratch_surface.get_width())
+      height = max(height, _scratch_surface.get_height())
+    _scratch_surface = cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+    _scratch_ctx = cairo.Context(_scratch_surface)
+
+  if clear:
+    _scratch_ctx.save()
+    _scratch_ctx.set_operator(cairo.OPERATOR_CLEAR)
+    _scratch_ctx.paint()
+    _scratch_ctx.restore()
+  return _scratch_ctx
+
+
+def _sample_texts(subsets):
+  """ Returns the sample text and the x-height glyph to use for a font
+      supporting the given subsets. """
+  #TODO: There should be a dict of sample strings per subset
+  # instead of just the khmer special case below:
+  if 'khmer' in subsets:
+    return KHMER_TEXT, b'\xE1\x9E\x85'.decode("utf-8")
+  else:
+    return LATIN_TEXT, 'x'
 
 
 def compute_darkness_and_width(fontfile, subsets):
@@ -253,49 +433,48 @@ def compute_darkness_and_width(fontfile, subsets):
 
      Both values should be normalized.
   """
+  _require_numpy()
   print ("Computing... {}".format(fontfile))
 
-  #TODO: There should be a dict of sample strings per subset
-  # instead of just the khmer special case below:
-  if 'khmer' in subsets:
-    sample_text = KHMER_TEXT
-    sample_xheight = '\xE1\x9E\x85'
-  else:
-    sample_text = LATIN_TEXT
-    sample_xheight = 'x'
+  sample_text, sample_xheight = _sample_texts(subsets)
 
   face = create_cairo_font_face_for_file(fontfile, 0)
 
-  #dummy surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
-  ctx = cairo.Context(surface)
+  # Shape the sample text only once: the same glyphs are used both to
+  # size the raster and to draw onto it. They are measured with the
+  # scratch A8 context's scaled font, i.e. the one we render with.
+  ctx = _get_scratch_context(0, 0, clear=False)
+  ctx.save()
   ctx.set_font_face(face)
   ctx.set_font_size(FONT_SIZE)
-  xbearing, ybearing, text_width, text_height, _, _ = ctx.text_extents(sample_text)
-  _, _, _, x_height, _, _ = ctx.text_extents(sample_xheight)
-
-
-  #actual surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(text_width), int(text_height))
-  ctx = cairo.Context(surface)
-
-  ctx.set_font_face(face)
-  ctx.set_font_size(FONT_SIZE)
-  ctx.move_to(-xbearing, -ybearing)
-  ctx.show_text(sample_text)
-
+  scaled_font = ctx.get_scaled_font()
+  ctx.restore()
+
+  glyphs = scaled_font.text_to_glyphs(0, 0, sample_text, False)
+  xbearing, ybearing, text_width, text_height, _, _ = scaled_font.glyph_extents(glyphs)
+  _, _, _, x_height, _, _ = scaled_font.text_extents(sample_xheight)
+
+  data_width = int(text_width)
+  data_height = int(text_height)
+
+  #actual surface (only the top-left data_width x data_height area is used)
+  ctx = _get_scratch_context(data_width, data_height)
+  ctx.save()
+  ctx.set_scaled_font(scaled_font)
+  ctx.translate(-xbearing, -ybearing)
+  ctx.show_glyphs(glyphs)
+  ctx.restore()
+
+  surface = ctx.get_target()
+  surface.flush()
   pixel_data = surface.get_data()
-  data_width = surface.get_width()
   data_stride = surface.get_stride()
-  data_height = surface.get_height()
-
-  avg = 0.0
-  for x in xrange(data_width):
-    for y in xrange(data_height):
-      alpha = ord(pixel_data[y*data_stride + 4*x + 3])
-      avg += alpha/255.0
 
-  darkness = avg / (data_width * data_height)
+  # We only care about ink coverage, so the surface is A8
+  # and its pixel data is the alpha plane itself:
+  buf = np.frombuffer(pixel_data, dtype=np.uint8)
+  total = _sum_alpha(buf, data_stride, data_width, data_height)
+  darkness = total / (255.0 * data_width * data_height)
 
   width = text_width / float(x_height)
 